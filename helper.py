@@ -3,25 +3,60 @@ Binary Ninja plugin that aids in analysis of UEFI PEI and DXE modules
 """
 
 import os
+import sys
 import csv
 import glob
 import uuid
-from binaryninja import (BackgroundTaskThread, SegmentFlag, SectionSemantics, BinaryReader, Symbol,
-                         SymbolType, HighLevelILOperation, BinaryView, TypeLibrary)
+import itertools
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from binaryninja import (BackgroundTaskThread, SegmentFlag, SectionSemantics, Symbol,
+                         SymbolType, HighLevelILOperation, BinaryView, TypeLibrary, TypeClass)
+from binaryninja.function import Function
 from binaryninja.highlevelil import HighLevelILInstruction
 from binaryninja.types import (Type, FunctionParameter)
 
-class UEFIHelper(BackgroundTaskThread):
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_ASSIGN_OPS = (HighLevelILOperation.HLIL_ASSIGN, HighLevelILOperation.HLIL_ASSIGN_UNPACK)
+_CALL_OPS = (HighLevelILOperation.HLIL_CALL, HighLevelILOperation.HLIL_TAILCALL)
+
+# EFI_BOOT_SERVICES members that take a protocol GUID, mapped to the param indices of the GUID pointer and protocol
+# variable pointer
+PROTOCOL_SERVICES = {
+    'InstallProtocolInterface': (1, 3),
+    'LocateProtocol': (0, 2),
+    'InstallMultipleProtocolInterfaces': (1, 2),
+}
+
+class UEFIHelper(BackgroundTaskThread): # pylint: disable=too-many-instance-attributes
     """Class for analyzing UEFI firmware to automate GUID annotation, segment fixup, type imports, and more
     """
 
+    # Set to True to print verbose tracing of GUID and global variable analysis
+    DEBUG = False
+
+    # Global symbol names for UEFI core types, keyed by the (token count, first token) of the assigned variable type
+    _CORE_TYPE_MAP = {
+        (1, 'EFI_HANDLE'): 'gHandle',
+        (2, 'EFI_BOOT_SERVICES'): 'gBS',
+        (2, 'EFI_RUNTIME_SERVICES'): 'gRS',
+        (2, 'EFI_SYSTEM_TABLE'): 'gST',
+        (1, 'EFI_PEI_FILE_HANDLE'): 'gHandle',
+        (2, 'EFI_PEI_SERVICES'): 'gPeiServices',
+    }
+
     def __init__(self, bv: BinaryView):
         BackgroundTaskThread.__init__(self, '', False)
         self.bv = bv
-        self.br = BinaryReader(self.bv)
         self.dirname = os.path.dirname(os.path.abspath(__file__))
-        self.guids = self._load_guids()
+        self._load_guids()
         self.gbs_assignments = []
+        self.param_types = dict()
+        self.efi_guid_type = None
 
     def _fix_segments(self):
         """UEFI modules run during boot, without page protections. Everything is RWX despite that the PE is built with
@@ -29,6 +64,11 @@ class UEFIHelper(BackgroundTaskThread):
         properly.
         """
 
+        # Index sections by start address once instead of querying the sections at each segment
+        sections_by_start = dict()
+        for section in self.bv.sections.values():
+            sections_by_start.setdefault(section.start, []).append(section)
+
         for seg in self.bv.segments:
             # Make segment RWX
             self.bv.add_user_segment(
@@ -37,7 +77,7 @@ class UEFIHelper(BackgroundTaskThread):
             )
 
             # Make section semantics ReadWriteDataSectionSemantics
-            for section in self.bv.get_sections_at(seg.start):
+            for section in sections_by_start.get(seg.start, []):
                 self.bv.add_user_section(section.name, section.end-section.start,
                                          SectionSemantics.ReadWriteDataSectionSemantics)
 
@@ -69,40 +109,33 @@ class UEFIHelper(BackgroundTaskThread):
             _start.parameter_vars[1].name = "SystemTable"
 
     def _load_guids(self):
-        """Read known GUIDs from CSV and convert string GUIDs to bytes
-
-        :return: Dictionary containing GUID bytes and associated names
+        """Read known GUIDs from CSV and build the lookup tables used to find them: GUID bytes -> name, and the GUID
+        prefixes used to locate candidate offsets
         """
 
+        self._guid_to_name = dict()
         guids_path = os.path.join(self.dirname, 'guids.csv')
         with open(guids_path) as f:
-            reader = csv.reader(f, skipinitialspace=True)
-            guids = dict(reader)
+            for guid, name in csv.reader(f, skipinitialspace=True):
+                self._guid_to_name[uuid.UUID(guid).bytes_le] = name
 
-        # Convert to bytes for faster lookup
-        guid_bytes = dict()
-        for guid, name in guids.items():
-            guid_bytes[name] = uuid.UUID(guid).bytes_le
-
-        return guid_bytes
+        # First 4 bytes of every known GUID as native-endian words, used to locate candidate offsets
+        self._guid_prefixes = frozenset(int.from_bytes(guid[:4], sys.byteorder) for guid in self._guid_to_name)
+        if np is not None:
+            self._guid_prefix_array = np.array(sorted(self._guid_prefixes), dtype=np.uint32)
 
     def _apply_guid_name_if_data(self, name: str, address: int):
-        """Check if there is a function at the address. If not, then apply the EFI_GUID type and name it
+        """Apply the EFI_GUID type and name to a GUID found in data
 
         :param name: Name/symbol to apply to the GUID
         :param address: Address of the GUID
         """
 
-        print(f'Found {name} at {hex(address)} ({uuid.UUID(bytes_le=self.guids[name])})')
-
-        # Just to avoid a unlikely false positive and screwing up disassembly
-        if self.bv.get_functions_at(address) != []:
-            print(f'There is code at {address}, not applying GUID type and name')
-            return
+        if self.DEBUG:
+            print(f'Found {name} at {hex(address)} ({uuid.UUID(bytes_le=self.bv.read(address, 16))})')
 
         self.bv.define_user_symbol(Symbol(SymbolType.DataSymbol, address, 'g'+name))
-        t = self.bv.parse_type_string("EFI_GUID")
-        self.bv.define_user_data_var(address, t[0])
+        self.bv.define_user_data_var(address, self.efi_guid_type)
 
     def _check_guid_and_get_name(self, guid: bytes) -> str:
         """Check if the GUID is in guids.csv and if it is, return the name
@@ -111,75 +144,170 @@ class UEFIHelper(BackgroundTaskThread):
         :return str: Name of the GUID
         """
 
-        names_list = list(self.guids.keys())
-        guids_list = list(self.guids.values())
-        try:
-            return names_list[guids_list.index(guid)]
-        except ValueError:
-            return None
+        return self._guid_to_name.get(guid)
 
 
-    def _find_known_guids(self):
-        """Search for known GUIDs and apply names to matches not within a function
+    def _find_guid_candidates(self, data: bytes) -> list:
+        """Find offsets in the buffer where the first 4 bytes match the prefix of a known GUID. The buffer is compared
+        as 32-bit words at each of the 4 possible alignments, with NumPy if it's available.
+
+        :param data: Buffer to search
+        :return: List of candidate offsets in ascending order
+        """
+
+        view = memoryview(data)
+        offsets = []
+        for align in range(4):
+            count = (len(data)-align) // 4
+            if count <= 0:
+                continue
+
+            if np is not None:
+                words = np.frombuffer(data, dtype=np.uint32, count=count, offset=align)
+                hits = np.flatnonzero(np.isin(words, self._guid_prefix_array)).tolist()
+            else:
+                # Cast a slice of the buffer to words without copying it, and keep the iteration in C by selecting
+                # word indices with a map over the prefix set membership test
+                words = view[align:align+count*4].cast('I')
+                hits = itertools.compress(itertools.count(), map(self._guid_prefixes.__contains__, words))
+            offsets.extend(i*4 + align for i in hits)
+
+        return sorted(i for i in offsets if i <= len(data)-16)
+
+    def _get_guid_scan_ranges(self) -> list:
+        """GUIDs live in data, so leave the bytes covered by basic blocks out of the scan. Segment flags and section
+        semantics can't be used for this since everything is RWX after the fixup, and compilers may merge read-only
+        data into the code section.
+
+        :return: List of (start, end) address ranges to scan
         """
 
+        # Functions whose analysis was skipped (e.g. too large or timed out) have no basic blocks, so always exclude the
+        # function start to avoid applying a GUID over code
+        blocks = []
+        for func in self.bv.functions:
+            blocks.append((func.start, func.start+1))
+            blocks.extend((bb.start, bb.end) for bb in func.basic_blocks)
+
+        # Merge overlapping ranges into sorted, disjoint code ranges
+        code = []
+        for start, end in sorted(blocks):
+            if code and start <= code[-1][1]:
+                code[-1][1] = max(code[-1][1], end)
+            else:
+                code.append([start, end])
+
+        ranges = []
         for seg in self.bv.segments:
-            for i in range(seg.start, seg.end):
-                self.br.seek(i)
-                data = self.br.read(16)
-                if not data or len(data) != 16:
+            start = seg.start
+            for code_start, code_end in code:
+                if code_end <= start:
                     continue
 
-                found_name = self._check_guid_and_get_name(data)
+                if code_start >= seg.end:
+                    break
+
+                if code_start > start:
+                    ranges.append((start, code_start))
+                start = code_end
+
+            if start < seg.end:
+                ranges.append((start, seg.end))
+
+        return ranges
+
+    def _find_known_guids(self):
+        """Search for known GUIDs and apply names to matches not within a function
+        """
+
+        found = []
+        for start, end in self._get_guid_scan_ranges():
+            # Read the range once and verify the full 16 bytes at each candidate offset
+            data = self.bv.read(start, end-start)
+            for i in self._find_guid_candidates(data):
+                found_name = self._guid_to_name.get(data[i:i+16])
                 if found_name:
-                    self._apply_guid_name_if_data(found_name, i)
+                    found.append((found_name, start+i))
 
-    def _set_if_uefi_core_type(self, instr: HighLevelILInstruction):
+        # Apply names once the scan is complete so the segment reads aren't interleaved with BinaryView updates
+        for found_name, address in found:
+            self._apply_guid_name_if_data(found_name, address)
+
+    def _get_uefi_core_type_assignment(self, instr: HighLevelILInstruction) -> tuple:
         """Using HLIL, scrutinize the instruction to determine if it's a move of a local variable to a global variable.
-        If it is, check if the source operand type is a UEFI core type and apply the type to the destination global
-        variable.
+        If it is, check if the source operand type is a UEFI core type.
 
         :param instr: High level IL instruction object
+        :return: Tuple containing the global variable address, symbol name, and type, or None if not a UEFI core type
         """
 
-        print("%x: checking %s" % (instr.address, instr))
+        if self.DEBUG:
+            print("%x: checking %s" % (instr.address, instr))
         if instr.operation != HighLevelILOperation.HLIL_ASSIGN:
-            print("%x: NOT ASSIGN %s" % (instr.address, instr))
-            return
+            if self.DEBUG:
+                print("%x: NOT ASSIGN %s" % (instr.address, instr))
+            return None
 
         if instr.dest.operation != HighLevelILOperation.HLIL_DEREF:
-            print("%x: DEST NOT DEREF %s" % (instr.address, instr.dest))
-            return
+            if self.DEBUG:
+                print("%x: DEST NOT DEREF %s" % (instr.address, instr.dest))
+            return None
 
         if instr.dest.src.operation != HighLevelILOperation.HLIL_CONST_PTR:
-            print("%x: DEST.SRC NOT CONST_PTR %s" % (instr.address, instr.dest.src))
-            return
+            if self.DEBUG:
+                print("%x: DEST.SRC NOT CONST_PTR %s" % (instr.address, instr.dest.src))
+            return None
 
         if instr.src.operation != HighLevelILOperation.HLIL_VAR:
-            print("%x: SRC NOT VAR %s" % (instr.address, instr.src))
-            return
+            if self.DEBUG:
+                print("%x: SRC NOT VAR %s" % (instr.address, instr.src))
+            return None
 
         _type = instr.src.var.type
-        print("%x: VAR TYPE %s" % (instr.address, instr.src.var.type))
-        if len(_type.tokens) == 1 and str(_type.tokens[0]) == 'EFI_HANDLE':
-            self.bv.define_user_symbol(Symbol(SymbolType.DataSymbol, instr.dest.src.constant, 'gHandle'))
-        elif len(_type.tokens) == 2 and str(_type.tokens[0]) == 'EFI_BOOT_SERVICES':
-            self.bv.define_user_symbol(Symbol(SymbolType.DataSymbol, instr.dest.src.constant, 'gBS'))
-            self.gbs_assignments.append(instr.dest.src.constant)
-        elif len(_type.tokens) == 2 and str(_type.tokens[0]) == 'EFI_RUNTIME_SERVICES':
-            self.bv.define_user_symbol(Symbol(SymbolType.DataSymbol, instr.dest.src.constant, 'gRS'))
-        elif len(_type.tokens) == 2 and str(_type.tokens[0]) == 'EFI_SYSTEM_TABLE':
-            self.bv.define_user_symbol(Symbol(SymbolType.DataSymbol, instr.dest.src.constant, 'gST'))
-        elif len(_type.tokens) == 1 and str(_type.tokens[0]) == 'EFI_PEI_FILE_HANDLE':
-            self.bv.define_user_symbol(Symbol(SymbolType.DataSymbol, instr.dest.src.constant, 'gHandle'))
-        elif len(_type.tokens) == 2 and str(_type.tokens[0]) == 'EFI_PEI_SERVICES':
-            self.bv.define_user_symbol(Symbol(SymbolType.DataSymbol, instr.dest.src.constant, 'gPeiServices'))
-        else:
-            print("%x: NONE MATCHED %s, %s" % (instr.address, _type.tokens, instr.dest.src.constant))
-            return
+        if self.DEBUG:
+            print("%x: VAR TYPE %s" % (instr.address, _type))
+        # Type.tokens renders the type on every access, so only fetch it once
+        tokens = _type.tokens
+        name = self._CORE_TYPE_MAP.get((len(tokens), str(tokens[0]))) if tokens else None
+        if name is None:
+            if self.DEBUG:
+                print("%x: NONE MATCHED %s, %s" % (instr.address, tokens, instr.dest.src.constant))
+            return None
+
+        return instr.dest.src.constant, name, _type
+
+    def _find_uefi_core_type_assignments(self, func: Function) -> list:
+        """Walk the function's HLIL and collect assignments of UEFI core types to global variables. This doesn't modify
+        the BinaryView so it can safely run in a worker thread.
 
-        self.bv.define_user_data_var(instr.dest.src.constant, instr.src.var.type)
-        print(f'Found global assignment - offset:{hex(instr.dest.src.constant)} type:{instr.src.var.type}')
+        :param func: Function to analyze
+        :return: List of (address, name, type) tuples
+        """
+
+        assignments = []
+        for block in func.high_level_il:
+            for instr in block:
+                assignment = self._get_uefi_core_type_assignment(instr)
+                if assignment:
+                    assignments.append(assignment)
+
+        return assignments
+
+    def _set_uefi_core_type(self, address: int, name: str, _type: Type):
+        """Apply the symbol and type of a UEFI core type to a global variable
+
+        :param address: Address of the global variable
+        :param name: Name/symbol to apply to the global variable
+        :param _type: Type to apply to the global variable
+        """
+
+        self.bv.define_user_symbol(Symbol(SymbolType.DataSymbol, address, name))
+        if name == 'gBS':
+            self.gbs_assignments.append(address)
+
+        self.bv.define_user_data_var(address, _type)
+        if self.DEBUG:
+            print(f'Found global assignment - offset:{hex(address)} type:{_type}')
 
     def _check_and_prop_types_on_call(self, instr: HighLevelILInstruction):
         """Most UEFI modules don't assign globals in the entry function and instead call a initialization routine and
@@ -189,40 +317,69 @@ class UEFIHelper(BackgroundTaskThread):
         :param instr: High level IL instruction object
         """
 
-        if instr.operation in [HighLevelILOperation.HLIL_ASSIGN, HighLevelILOperation.HLIL_ASSIGN_UNPACK]:
-            instr = instr.src;
+        if instr.operation in _ASSIGN_OPS:
+            instr = instr.src
 
-        if instr.operation not in [HighLevelILOperation.HLIL_TAILCALL, HighLevelILOperation.HLIL_CALL]:
+        if instr.operation not in _CALL_OPS:
             return
 
         if instr.dest.operation != HighLevelILOperation.HLIL_CONST_PTR:
             return
 
         func = self.bv.get_function_at(instr.dest.constant)
-        
-        num_params = len(func.parameter_vars)
+        if func is None:
+            return
+
+        # Queue the updates so that each parameter is only changed once, even if the function is called several times
+        num_params = min(len(func.parameter_vars), len(instr.params))
         for i in range(num_params):
             arg = instr.params[i]
             if hasattr(arg, 'var'):
                 typename = arg.var.type
                 if "EFI_" in str(typename):
-                    func.parameter_vars[i].name = arg.var.name
-                    func.parameter_vars[i].type = arg.var.type
+                    self.param_types[(func.start, i)] = (func, arg.var.name, typename)
+
+    def _apply_param_types(self):
+        """Apply the parameter names and types queued by _check_and_prop_types_on_call
+        """
+
+        params = dict()
+        for (start, i), (func, name, _type) in self.param_types.items():
+            if start not in params:
+                params[start] = func.parameter_vars
+
+            func.create_user_var(params[start][i], _type, name)
+
+        self.param_types.clear()
 
     def _set_global_variables(self):
         """On entry, UEFI modules usually set global variables for EFI_BOOT_SERVICES, EFI_RUNTIME_SERIVCES, and
         EFI_SYSTEM_TABLE. This function attempts to identify these assignments and apply types.
         """
 
-        func = self.bv.get_function_at(self.bv.entry_point)
-        for block in func.high_level_il:
-            for instr in block:
-                self._check_and_prop_types_on_call(instr)
-
-        for func in self.bv.functions:
-            for block in func.high_level_il:
+        # Walk the entry function first so that types are propagated to the initialization routines it calls before
+        # they are scanned for global assignments
+        entry = self.bv.get_function_at(self.bv.entry_point)
+        if entry:
+            for block in entry.high_level_il:
                 for instr in block:
-                    self._set_if_uefi_core_type(instr)
+                    self._check_and_prop_types_on_call(instr)
+                    assignment = self._get_uefi_core_type_assignment(instr)
+                    if assignment:
+                        self._set_uefi_core_type(*assignment)
+
+            # The callees' HLIL only reflects the new parameter types once analysis has been updated
+            self._apply_param_types()
+            self.bv.update_analysis_and_wait()
+
+        # Walk the remaining functions concurrently and apply the results from this thread once all have been collected
+        funcs = [func for func in self.bv.functions if func != entry]
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            results = list(executor.map(self._find_uefi_core_type_assignments, funcs))
+
+        for assignments in results:
+            for assignment in assignments:
+                self._set_uefi_core_type(*assignment)
 
     def _name_proto_from_guid(self, guid_addr: int, var_addr: int):
         """Read the GUID, look it up in guids.csv, and derive the var name from the GUID name
@@ -231,8 +388,7 @@ class UEFIHelper(BackgroundTaskThread):
         :param var_addr: Address to create the symbol
         """
 
-        self.br.seek(guid_addr)
-        guid = self.br.read(16)
+        guid = self.bv.read(guid_addr, 16)
         if len(guid) != 16:
             return
 
@@ -245,70 +401,168 @@ class UEFIHelper(BackgroundTaskThread):
         print(f'Found {name} at {hex(var_addr)}')
         self.bv.define_user_symbol(Symbol(SymbolType.DataSymbol, var_addr, name))
 
-    def _name_protocol_var(self, instr: HighLevelILInstruction, guid_idx: int, proto_idx: int):
-        """Set the global protocol variable name by analyzing the call to gBS->LocateProtocol,
+    def _get_protocol_var(self, instr: HighLevelILInstruction, guid_idx: int, proto_idx: int) -> tuple:
+        """Get the GUID and global protocol variable addresses by analyzing the call to gBS->LocateProtocol,
         gBS->InstallMultipleProtocolInterfaces, or gBS->InstallProtocol
 
         :param instr: HLIL instruction
         :param guid_idx: Param index for the GUID pointer
         :param proto_idx: Param index for the protocol variable pointer
+        :return: Tuple containing the GUID address and protocol variable address, or None
         """
 
-        # Get the largest param index and make sure it doesn't exceed the instruction param count
-        param_indices = [guid_idx, proto_idx]
-        param_indices.sort()
-        if len(instr.params) < param_indices[-1]:
-            return
+        # Make sure the largest param index doesn't exceed the instruction param count
+        if len(instr.params) <= max(guid_idx, proto_idx):
+            return None
 
         if instr.params[guid_idx].operation != HighLevelILOperation.HLIL_CONST_PTR:
-            return
+            return None
 
         if instr.params[proto_idx].operation != HighLevelILOperation.HLIL_CONST_PTR:
-            return
+            return None
+
+        return instr.params[guid_idx].constant, instr.params[proto_idx].constant
+
+    def _resolve_named_type(self, _type: Type) -> Type:
+        """Follow a named type reference (i.e. a typedef) to the type it refers to
+
+        :param _type: Type to resolve
+        :return: Resolved type, or None if the type or its reference can't be resolved
+        """
+
+        while _type is not None and _type.type_class == TypeClass.NamedTypeReferenceClass:
+            # Newer API versions expose the referenced type ID on the type itself, older ones on named_type_reference
+            type_id = getattr(_type, 'type_id', None)
+            if type_id is None:
+                type_id = _type.named_type_reference.type_id
+            _type = self.bv.get_type_by_id(type_id)
+
+        return _type
+
+    def _get_protocol_services(self) -> tuple:
+        """Look up the EFI_BOOT_SERVICES structure and the offsets of its members that take a protocol GUID
+
+        :return: Tuple containing the EFI_BOOT_SERVICES structure type and a dictionary of member offsets mapped to the
+            GUID and protocol param indices
+        """
 
-        self._name_proto_from_guid(instr.params[guid_idx].constant, instr.params[proto_idx].constant)
+        boot_services = self._resolve_named_type(self.bv.get_type_by_name('EFI_BOOT_SERVICES'))
+        if boot_services is None or boot_services.type_class != TypeClass.StructureTypeClass:
+            return None, {}
+
+        # Older API versions keep the members on Type.structure, newer ones on the structure type itself
+        structure = getattr(boot_services, 'structure', None) or boot_services
+        protocol_services = dict()
+        for member in structure.members:
+            if member.name in PROTOCOL_SERVICES:
+                protocol_services[member.offset] = PROTOCOL_SERVICES[member.name]
+
+        return boot_services, protocol_services
+
+    def _find_protocol_vars(self, func: Function, boot_services: Type, protocol_services: dict) -> list:
+        """Walk the function's HLIL and collect the GUID and protocol variable addresses passed to protocol services.
+        This doesn't modify the BinaryView so it can safely run in a worker thread.
+
+        :param func: Function to analyze
+        :param boot_services: EFI_BOOT_SERVICES structure type
+        :param protocol_services: EFI_BOOT_SERVICES member offsets mapped to the GUID and protocol param indices
+        :return: List of (GUID address, protocol variable address) tuples
+        """
+
+        protocol_vars = []
+        for block in func.high_level_il:
+            for instr in block:
+                if instr.operation != HighLevelILOperation.HLIL_CALL:
+                    continue
+
+                if instr.dest.operation != HighLevelILOperation.HLIL_DEREF_FIELD:
+                    continue
+
+                param_indices = protocol_services.get(instr.dest.offset)
+                if not param_indices:
+                    continue
+
+                # Only dispatch on members dereferenced through an EFI_BOOT_SERVICES pointer
+                src_type = instr.dest.src.expr_type
+                if src_type is None or src_type.type_class != TypeClass.PointerTypeClass:
+                    continue
+
+                if self._resolve_named_type(src_type.target) != boot_services:
+                    continue
+
+                protocol_var = self._get_protocol_var(instr, *param_indices)
+                if protocol_var:
+                    protocol_vars.append(protocol_var)
+
+        return protocol_vars
 
     def _name_protocol_vars(self):
         """Iterate xref's for EFI_BOOT_SERVICES global variables, find calls to gBS->LocateProtocol and
         gBS->InstallMultipleProtocolInterfaces, and apply a name and type based on the GUID (if known)
         """
 
+        # Compare the dereferenced member by offset rather than rendering the HLIL to match on the member name
+        boot_services, protocol_services = self._get_protocol_services()
+        if boot_services is None:
+            return
+
+        # Several xrefs usually land in the same function, so only walk each function once
+        funcs = []
+        seen_funcs = set()
         for assignment in self.gbs_assignments:
             for xref in self.bv.get_code_refs(assignment):
-                funcs = self.bv.get_functions_containing(xref.address)
-                if not funcs:
+                containing = self.bv.get_functions_containing(xref.address)
+                if not containing or containing[0].start in seen_funcs:
                     continue
 
-                for block in funcs[0].high_level_il:
-                    for instr in block:
-                        if instr.operation != HighLevelILOperation.HLIL_CALL:
-                            continue
+                seen_funcs.add(containing[0].start)
+                funcs.append(containing[0])
+
+        # Walk the functions concurrently and name the protocol variables from this thread once all have been collected
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            results = list(executor.map(lambda func: self._find_protocol_vars(func, boot_services, protocol_services),
+                                        funcs))
+
+        for protocol_vars in results:
+            for guid_addr, var_addr in protocol_vars:
+                self._name_proto_from_guid(guid_addr, var_addr)
 
-                        if instr.dest.operation != HighLevelILOperation.HLIL_DEREF_FIELD:
-                            continue
+    @contextlib.contextmanager
+    def _undo_actions(self):
+        """Group the user changes made within the context into a single undo action. The action is committed even if an
+        exception is raised, so an undo group is never left open on the view.
+        """
 
-                        # Could also use the structure offset or member index here
-                        if str(instr.dest).endswith('->LocateProtocol'):
-                            self._name_protocol_var(instr, 0, 2)
-                        elif str(instr.dest).endswith('->InstallMultipleProtocolInterfaces'):
-                            self._name_protocol_var(instr, 1, 2)
-                        elif str(instr.dest).endswith('->InstallProtocolInterface'):
-                            self._name_protocol_var(instr, 1, 3)
+        # Newer API versions return an id for the undo group that has to be passed back when committing it
+        undo_id = self.bv.begin_undo_actions()
+        try:
+            yield
+        finally:
+            if undo_id is None:
+                self.bv.commit_undo_actions()
+            else:
+                self.bv.commit_undo_actions(undo_id)
 
     def run(self):
         """Run the task in the background
         """
 
-        self.progress = "UEFI Helper: Fixing up segments, applying types, and searching for known GUIDs ..."
-        self._fix_segments()
-        self._import_types_from_headers()
-        self._set_entry_point_prototype()
-        self._find_known_guids()
-        self.progress = "UEFI Helper: searching for global assignments for UEFI core services ..."
-        self._set_global_variables()
+        # Group the user changes of each phase into a single undo action. Analysis is updated between the phases
+        # because protocol calls are only rendered as gBS member dereferences after the global types are applied.
+        with self._undo_actions():
+            self.progress = "UEFI Helper: Fixing up segments, applying types, and searching for known GUIDs ..."
+            self._fix_segments()
+            self._import_types_from_headers()
+            self.efi_guid_type = self.bv.parse_type_string("EFI_GUID")[0]
+            self._set_entry_point_prototype()
+            self._find_known_guids()
+            self.progress = "UEFI Helper: searching for global assignments for UEFI core services ..."
+            self._set_global_variables()
         self.bv.update_analysis_and_wait()
-        self.progress = "UEFI Helper: searching for global protocols ..."
-        self._name_protocol_vars()
+
+        with self._undo_actions():
+            self.progress = "UEFI Helper: searching for global protocols ..."
+            self._name_protocol_vars()
         print('UEFI Helper completed successfully!')
 
 def run_uefi_helper(bv: BinaryView):